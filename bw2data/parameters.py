@@ -1,10 +1,15 @@
-import datetime
+import ast
+import collections
+import contextlib
 import itertools
+import json
+import operator
 import re
 import uuid
 
 import asteval
 from asteval import Interpreter
+from asteval.astutils import MAX_EXPONENT
 from bw2parameters import ParameterSet
 from bw2parameters.errors import MissingName
 from peewee import (
@@ -13,18 +18,45 @@ from peewee import (
     DateTimeField,
     FloatField,
     IntegerField,
+    IntegrityError,
     Model,
+    OperationalError,
+    SQL,
     TextField,
+    __exception_wrapper__,
+    chunked,
 )
 
 from . import config, databases, get_activity, projects
+from .backends import sqlite3_lci_db
 from .backends.schema import ExchangeDataset
-from .sqlite import PickleField, SubstitutableDatabase
+from .sqlite import JSONPickleField, SubstitutableDatabase
 
 # https://stackoverflow.com/questions/34544784/arbitrary-string-to-valid-python-name
 clean = lambda x: re.sub(r"\W|^(?=\d)", "_", x)
 nonempty = lambda dct: {k: v for k, v in dct.items() if v is not None}
 
+"""Key to sort parameters by name, e.g. ``sorted(params, key=parameter_sort_key)``. Computes each lowercased name once, instead of twice per ``__lt__`` comparison."""
+parameter_sort_key = operator.attrgetter("_name_lower")
+
+"""``Group`` objects by name, cached while recalculating. See ``Group.get_cached``."""
+_GROUP_CACHE = {}
+_RECALC_DEPTH = 0
+
+
+@contextlib.contextmanager
+def _recalc_context():
+    """Cache ``Group`` lookups until the outermost recalculation finishes"""
+    global _RECALC_DEPTH
+    _RECALC_DEPTH += 1
+    try:
+        yield
+    finally:
+        _RECALC_DEPTH -= 1
+        if not _RECALC_DEPTH:
+            _GROUP_CACHE.clear()
+
+
 """Autoupdate `updated` field in Group when parameters change"""
 AUTOUPDATE_TRIGGER = """CREATE TRIGGER IF NOT EXISTS {table}_{action}_trigger AFTER {action} ON {table} BEGIN
     UPDATE group_table SET updated = datetime('now') WHERE name = {name};
@@ -62,6 +94,63 @@ END;
 """
 GD_INSERT_TRIGGER = _CLOSURE_TEMPLATE.format(action="INSERT")
 GD_UPDATE_TRIGGER = _CLOSURE_TEMPLATE.format(action="UPDATE")
+"""Checked in Python instead, as the triggers scan ``groupdependency`` for every inserted row. Set to ``True`` to create the triggers again."""
+GD_LEGACY_TRIGGERS = False
+
+"""Insert many parameters with ``executemany``"""
+BULK_INSERT = """INSERT INTO {table} ({columns}) VALUES ({values})"""
+
+"""Find where names needed by an activity parameter group are defined, in one query. Groups and names are passed as JSON arrays, so the number of bound variables doesn't grow past sqlite's limit."""
+DEPENDENCY_CHAIN_QUERY = """WITH groups(grp) AS (SELECT value FROM json_each(?)),
+wanted(name) AS (SELECT value FROM json_each(?))
+SELECT name, 'activity', "group" FROM activityparameter
+    WHERE "group" IN groups AND name IN wanted
+UNION ALL
+SELECT name, 'database', database FROM databaseparameter
+    WHERE database = ? AND name IN wanted
+UNION ALL
+SELECT name, 'project', 'project' FROM projectparameter
+    WHERE name IN wanted"""
+
+"""Add a default to ``updated`` in ``group_table`` created by older versions. Follows the sqlite procedure for schema changes; legacy renaming keeps the parameter triggers which refer to ``group_table`` unchanged."""
+GROUP_UPDATED_DEFAULT_MIGRATION = """
+PRAGMA legacy_alter_table = ON;
+BEGIN;
+CREATE TABLE "group_table_new" (
+    "id" INTEGER NOT NULL PRIMARY KEY,
+    "name" TEXT NOT NULL,
+    "fresh" INTEGER NOT NULL,
+    "updated" DATETIME NOT NULL DEFAULT (datetime('now')),
+    "order" TEXT NOT NULL
+);
+INSERT INTO "group_table_new" ("id", "name", "fresh", "updated", "order")
+    SELECT "id", "name", "fresh", "updated", "order" FROM "group_table";
+DROP TABLE "group_table";
+ALTER TABLE "group_table_new" RENAME TO "group_table";
+CREATE UNIQUE INDEX "group_table_name" ON "group_table" ("name");
+COMMIT;
+PRAGMA legacy_alter_table = OFF;
+"""
+
+"""Values of all variables in the dependency chain of an activity parameter group. Later rows have precedence:
+project, then database, then the groups in ``Group.order`` from last to first."""
+STATIC_DEPENDENCIES_QUERY = """WITH deps(grp, position) AS (
+    SELECT json_each.value, json_each.key FROM group_table, json_each(group_table."order")
+    WHERE group_table.name = ?
+)
+SELECT name, amount FROM (
+    SELECT name, amount, 0 AS rank, 0 AS position FROM projectparameter
+    UNION ALL
+    SELECT name, amount, 1, 0 FROM databaseparameter WHERE database = (
+        SELECT database FROM activityparameter WHERE "group" = ? LIMIT 1
+    )
+    UNION ALL
+    SELECT a.name, a.amount, 2, deps.position
+        FROM activityparameter AS a JOIN deps ON a."group" = deps.grp
+)
+ORDER BY rank, position DESC"""
+"""Set to ``False`` to use one query per group in ``ActivityParameter._static_dependencies``"""
+STATIC_DEPENDENCIES_QUERY_ENABLED = True
 
 """Parameterized exchange groups must be in activityparameters table"""
 _PE_GROUP_TEMPLATE = """CREATE TRIGGER IF NOT EXISTS pe_group_{action} BEFORE {action} ON parameterizedexchange BEGIN
@@ -82,7 +171,12 @@ class ParameterBase(Model):
         if type(self) != type(other):
             raise TypeError
         else:
-            return self.name.lower() < other.name.lower()
+            return self._name_lower < other._name_lower
+
+    @property
+    def _name_lower(self):
+        # Not cached, as parameters can be renamed
+        return self.name.lower()
 
     @classmethod
     def create_table(cls):
@@ -99,6 +193,57 @@ class ParameterBase(Model):
                 )
             )
 
+    @classmethod
+    def _load(cls, *where, data=True):
+        """Return ``load`` results for rows matching ``where``.
+
+        Reads tuples of the ``.dict`` columns, without creating model instances. ``data`` is only selected and decoded if ``data``."""
+        fields = [getattr(cls, name) for name in cls._dict_fields]
+        if data:
+            fields.append(cls.data)
+        query = cls.select(*fields)
+        if where:
+            query = query.where(*where)
+
+        result = {}
+        for row in query.tuples():
+            obj = {
+                name: value
+                for name, value in zip(cls._dict_fields, row)
+                if value is not None
+            }
+            if data and row[-1]:
+                obj.update(row[-1])
+            result[obj.pop("name")] = obj
+        return result
+
+    @classmethod
+    def _bulk_create(cls, rows):
+        """Insert ``rows`` in one transaction, expiring each affected group once instead of once per row.
+
+        Rows are inserted with a single ``executemany`` on the raw connection, which avoids building one peewee query per batch."""
+        fields = [f for f in cls._meta.sorted_fields if f is not cls._meta.primary_key]
+
+        def default(field):
+            return field.default() if callable(field.default) else field.default
+
+        sql = BULK_INSERT.format(
+            table=cls._meta.table_name,
+            columns=", ".join('"{}"'.format(f.column_name) for f in fields),
+            values=", ".join("?" * len(fields)),
+        )
+        values = [
+            tuple(
+                f.db_value(row[f.name] if f.name in row else default(f)) for f in fields
+            )
+            for row in rows
+        ]
+        database = cls._meta.database
+        with database.atomic(), __exception_wrapper__:
+            database.connection().executemany(sql, values)
+            for group in {cls._group_name(row) for row in rows}:
+                Group.expire_by_name(group)
+
     @staticmethod
     def expire_downstream(group):
         """Expire any activity parameters that depend on this group"""
@@ -108,6 +253,7 @@ class ParameterBase(Model):
                 GroupDependency.depends == group
             )
         ).execute()
+        _GROUP_CACHE.clear()
 
 
 class ProjectParameter(ParameterBase):
@@ -118,7 +264,7 @@ class ProjectParameter(ParameterBase):
         * name: str, unique
         * formula: str, optional
         * amount: float, optional
-        * data: object, optional. Used for any other metadata.
+        * data: object, optional. Used for any other metadata. Stored as JSON if possible, otherwise pickled.
 
     Note that there is no magic for reading and writing to ``data`` (unlike ``Activity`` objects) - it must be used directly.
 
@@ -127,28 +273,38 @@ class ProjectParameter(ParameterBase):
     name = TextField(index=True, unique=True)
     formula = TextField(null=True)
     amount = FloatField(null=True)
-    data = PickleField(default={})
+    data = JSONPickleField(default=dict)
 
     _old_name = "'project'"
     _new_name = "'project'"
     _db_table = "projectparameter"
+    _dict_fields = ("name", "formula", "amount")
+
+    class Meta:
+        # Covers ``static``, which can then be read from the index alone
+        indexes = ((("name", "amount"), False),)
 
     def __str__(self):
         return "Project parameter: {}".format(self.name)
 
-    def save(self, *args, **kwargs):
-        Group.get_or_create(name="project")[0].expire()
+    def save(self, *args, bulk=False, **kwargs):
+        """Save this model instance.
+
+        ``bulk`` skips expiring the ``project`` group, for callers which expire it once themselves."""
+        if not bulk:
+            Group.expire_by_name("project")
         super(ProjectParameter, self).save(*args, **kwargs)
 
     @staticmethod
-    def load(group=None):
-        """Return dictionary of parameter data with names as keys and ``.dict()`` as values."""
+    def _group_name(row):
+        return "project"
 
-        def reformat(o):
-            o = o.dict
-            return (o.pop("name"), o)
+    @staticmethod
+    def load(group=None, data=True):
+        """Return dictionary of parameter data with names as keys and ``.dict()`` as values.
 
-        return dict([reformat(o) for o in ProjectParameter.select()])
+        ``data`` includes the ``data`` metadata; it isn't needed for calculating amounts."""
+        return ProjectParameter._load(data=data)
 
     @staticmethod
     def static(ignored="project", only=None):
@@ -168,18 +324,19 @@ class ProjectParameter(ParameterBase):
     def expired():
         """Return boolean - is this group expired?"""
         try:
-            return not Group.get(name="project").fresh
+            return not Group.get_cached("project").fresh
         except Group.DoesNotExist:
             return False
 
     @staticmethod
+    @_recalc_context()
     def recalculate(ignored=None):
         """Recalculate all parameters.
 
         ``ignored`` included for API compatibility with other ``recalculate`` methods - it will really be ignored."""
         if not ProjectParameter.expired():
             return
-        data = ProjectParameter.load()
+        data = ProjectParameter.load(data=False)
         if not data:
             return
         ParameterSet(data).evaluate_and_set_amount_field()
@@ -209,7 +366,7 @@ class ProjectParameter(ParameterBase):
             ]
 
         """
-        data = ProjectParameter.load()
+        data = ProjectParameter.load(data=False)
         if not data:
             return []
 
@@ -254,7 +411,7 @@ class ProjectParameter(ParameterBase):
             for p in cls.select().where(cls.formula.contains(old))
         )
         cls.bulk_update(data, fields=[cls.formula], batch_size=50)
-        Group.get_or_create(name="project")[0].expire()
+        Group.expire_by_name("project")
 
     @property
     def dict(self):
@@ -266,7 +423,8 @@ class ProjectParameter(ParameterBase):
                 "amount": self.amount,
             }
         )
-        obj.update(self.data)
+        if self.data:
+            obj.update(self.data)
         return obj
 
 
@@ -279,7 +437,7 @@ class DatabaseParameter(ParameterBase):
         * name: str, unique within a database
         * formula: str, optional
         * amount: float, optional
-        * data: object, optional. Used for any other metadata.
+        * data: object, optional. Used for any other metadata. Stored as JSON if possible, otherwise pickled.
 
     Note that there is no magic for reading and writing to ``data`` (unlike ``Activity`` objects) - it must be used directly.
 
@@ -289,41 +447,38 @@ class DatabaseParameter(ParameterBase):
     name = TextField(index=True)
     formula = TextField(null=True)
     amount = FloatField(null=True)
-    data = PickleField(default={})
+    data = JSONPickleField(default=dict)
 
     _old_name = "OLD.database"
     _new_name = "NEW.database"
     _db_table = "databaseparameter"
+    _dict_fields = ("database", "name", "formula", "amount")
 
     class Meta:
-        indexes = ((("database", "name"), True),)
+        indexes = (
+            (("database", "name"), True),
+            # Covers ``static``, which can then be read from the index alone
+            (("database", "name", "amount"), False),
+        )
         constraints = [Check("database != 'project'")]
 
     def __str__(self):
         return "Database parameter: {}:{}".format(self.database, self.name)
 
     @staticmethod
-    def load(database):
-        """Return dictionary of parameter data with names as keys and ``.dict()`` as values."""
+    def load(database, data=True):
+        """Return dictionary of parameter data with names as keys and ``.dict()`` as values.
 
-        def reformat(o):
-            o = o.dict
-            return (o.pop("name"), o)
-
-        return dict(
-            [
-                reformat(o)
-                for o in DatabaseParameter.select().where(
-                    DatabaseParameter.database == database
-                )
-            ]
+        ``data`` includes the ``data`` metadata; it isn't needed for calculating amounts."""
+        return DatabaseParameter._load(
+            DatabaseParameter.database == database, data=data
         )
 
     @staticmethod
     def expired(database):
         """Return boolean - is this group expired?"""
         try:
-            return not Group.get(name=database).fresh
+            return not Group.get_cached(database).fresh
         except Group.DoesNotExist:
             return False
 
@@ -340,6 +495,7 @@ class DatabaseParameter(ParameterBase):
         return result
 
     @staticmethod
+    @_recalc_context()
     def recalculate(database):
         """Recalculate all database parameters for ``database``, if expired."""
         if ProjectParameter.expired():
@@ -348,7 +504,7 @@ class DatabaseParameter(ParameterBase):
         # Can we avoid doing anything?
         if not DatabaseParameter.expired(database):
             return
-        data = DatabaseParameter.load(database)
+        data = DatabaseParameter.load(database, data=False)
         if not data:
             return
 
@@ -382,7 +538,7 @@ class DatabaseParameter(ParameterBase):
                     DatabaseParameter.name == key,
                     DatabaseParameter.database == database,
                 ).execute()
-            Group.get(name=database).freshen()
+            Group.get_cached(database).freshen()
             DatabaseParameter.expire_downstream(database)
 
     @staticmethod
@@ -404,7 +560,7 @@ class DatabaseParameter(ParameterBase):
             ]
 
         """
-        data = DatabaseParameter.load(group)
+        data = DatabaseParameter.load(group, data=False)
         if not data:
             return []
 
@@ -450,11 +606,18 @@ class DatabaseParameter(ParameterBase):
         )
         return True if name in own_group.get("names", set()) else False
 
-    def save(self, *args, **kwargs):
-        """Save this model instance"""
-        Group.get_or_create(name=self.database)[0].expire()
+    def save(self, *args, bulk=False, **kwargs):
+        """Save this model instance.
+
+        ``bulk`` skips expiring the database group, for callers which expire it once themselves."""
+        if not bulk:
+            Group.expire_by_name(self.database)
         super(DatabaseParameter, self).save(*args, **kwargs)
 
+    @staticmethod
+    def _group_name(row):
+        return row["database"]
+
     def is_deletable(self):
         """Perform a test to see if the current parameter can be deleted."""
         # Test if the current parameter is used by other database parameters
@@ -512,7 +675,7 @@ class DatabaseParameter(ParameterBase):
         )
         cls.bulk_update(data, fields=[cls.formula], batch_size=50)
         for db in dbs:
-            Group.get_or_create(name=db)[0].expire()
+            Group.expire_by_name(db)
 
     @classmethod
     def update_formula_database_parameter_name(cls, old, new):
@@ -535,7 +698,7 @@ class DatabaseParameter(ParameterBase):
         )
         cls.bulk_update(data, fields=[cls.formula], batch_size=50)
         for db in dbs:
-            Group.get_or_create(name=db)[0].expire()
+            Group.expire_by_name(db)
 
     @property
     def dict(self):
@@ -548,7 +711,8 @@ class DatabaseParameter(ParameterBase):
                 "amount": self.amount,
             }
         )
-        obj.update(self.data)
+        if self.data:
+            obj.update(self.data)
         return obj
 
 
@@ -563,7 +727,7 @@ class ActivityParameter(ParameterBase):
         * name: str, unique within a group
         * formula: str, optional
         * amount: float, optional
-        * data: object, optional. Used for any other metadata.
+        * data: object, optional. Used for any other metadata. Stored as JSON if possible, otherwise pickled.
 
     Activities can only have parameters in one group. Group names cannot be 'project' or the name of any existing database.
 
@@ -587,35 +751,30 @@ class ActivityParameter(ParameterBase):
     name = TextField()
     formula = TextField(null=True)
     amount = FloatField(null=True)
-    data = PickleField(default={})
+    data = JSONPickleField(default=dict)
 
     _old_name = 'OLD."group"'
     _new_name = 'NEW."group"'
     _db_table = "activityparameter"
+    _dict_fields = ("database", "code", "name", "formula", "amount")
 
     class Meta:
-        indexes = [(("group", "name"), True)]
+        indexes = [
+            (("group", "name"), True),
+            # Covers ``static``, which can then be read from the index alone
+            (("group", "name", "amount"), False),
+        ]
         constraints = [Check("""("group" != 'project') AND ("group" != database)""")]
 
     def __str__(self):
         return "Activity parameter: {}:{}".format(self.group, self.name)
 
     @staticmethod
-    def load(group):
-        """Return dictionary of parameter data with names as keys and ``.dict()`` as values."""
+    def load(group, data=True):
+        """Return dictionary of parameter data with names as keys and ``.dict()`` as values.
 
-        def reformat(o):
-            o = o.dict
-            return (o.pop("name"), o)
-
-        return dict(
-            [
-                reformat(o)
-                for o in ActivityParameter.select().where(
-                    ActivityParameter.group == group
-                )
-            ]
-        )
+        ``data`` includes the ``data`` metadata; it isn't needed for calculating amounts."""
+        return ActivityParameter._load(ActivityParameter.group == group, data=data)
 
     @staticmethod
     def static(group, only=None, full=False):
@@ -640,10 +799,41 @@ class ActivityParameter(ParameterBase):
         """Get dictionary of ``{name: amount}`` for all variables defined in dependency chain.
 
         Be careful! This could have variables which overlap with local variable names. Designed for internal use."""
-        database = ActivityParameter.get(group=group).database
+        if STATIC_DEPENDENCIES_QUERY_ENABLED:
+            try:
+                return ActivityParameter._static_dependencies_query(group)
+            except OperationalError as error:
+                # Only fall back if ``order`` isn't JSON yet (not updated), or
+                # there is no JSON1 support
+                if "json" not in str(error).lower():
+                    raise
+        return ActivityParameter._static_dependencies_chain(group)
+
+    @staticmethod
+    def _static_dependencies_query(group):
+        """Get ``_static_dependencies`` with a single query. Rows are sorted so that later rows take precedence."""
+        rows = parameters.db.execute_sql(
+            STATIC_DEPENDENCIES_QUERY, (group, group)
+        ).fetchall()
+        return {name: amount for name, amount in rows}
+
+    @staticmethod
+    def _group_database(group):
+        """Get the database of the activities in ``group``, reading only the ``database`` column of one parameter."""
+        return (
+            ActivityParameter.select(ActivityParameter.database)
+            .where(ActivityParameter.group == group)
+            .get()
+            .database
+        )
+
+    @staticmethod
+    def _static_dependencies_chain(group):
+        """Get ``_static_dependencies`` with one query per group in the dependency chain."""
+        database = ActivityParameter._group_database(group)
 
         chain = [ProjectParameter.static(), DatabaseParameter.static(database)] + [
-            ActivityParameter.static(g) for g in Group.get(name=group).order[::-1]
+            ActivityParameter.static(g) for g in Group.get_cached(group).order[::-1]
         ]
 
         result = {}
@@ -675,7 +865,7 @@ class ActivityParameter(ParameterBase):
     def expired(group):
         """Return boolean - is this group expired?"""
         try:
-            return not Group.get(name=group).fresh
+            return not Group.get_cached(group).fresh
         except Group.DoesNotExist:
             return False
 
@@ -700,7 +890,7 @@ class ActivityParameter(ParameterBase):
             ]
 
         """
-        data = ActivityParameter.load(group)
+        data = ActivityParameter.load(group, data=False)
         if not data:
             return []
 
@@ -715,42 +905,42 @@ class ActivityParameter(ParameterBase):
         if not needed:
             return []
 
-        chain = []
-
-        # Iteratively search through other activity params,
-        # then db params, then project params
-        for new_group in Group.get(name=group).order:
-            names = set()
-            for name in ActivityParameter.static(new_group, only=needed):
-                names.add(name)
-                needed.remove(name)
-            if names:
-                chain.append({"kind": "activity", "group": new_group, "names": names})
-
-        if needed and include_self:
-            names = set()
-            included = needed.intersection(data)
-            for name in included:
-                names.add(name)
-                needed.remove(name)
-            if names:
-                chain.append({"kind": "activity", "group": group, "names": names})
+        # Sources in search order: other activity groups, then (optionally)
+        # this group, then db params, then project params
+        order = Group.get_cached(group).order
+        database = next(iter(data.values()))["database"]
+        sources = {}
+        for new_group in order:
+            sources.setdefault(("activity", new_group), len(sources))
+        if include_self:
+            sources.setdefault(("activity", group), len(sources))
+        sources.setdefault(("database", database), len(sources))
+        sources.setdefault(("project", "project"), len(sources))
+
+        rows = parameters.db.execute_sql(
+            DEPENDENCY_CHAIN_QUERY,
+            (json.dumps(order), json.dumps(sorted(needed)), database),
+        ).fetchall()
+        if include_self:
+            rows.extend((name, "activity", group) for name in needed.intersection(data))
+
+        # Each name is taken from the first source in the search order
+        found = {}
+        for name, kind, source in rows:
+            key = (kind, source)
+            if name not in found or sources[key] < sources[found[name]]:
+                found[name] = key
+
+        names = collections.defaultdict(set)
+        for name, key in found.items():
+            names[key].add(name)
+        chain = [
+            {"kind": kind, "group": source, "names": names[(kind, source)]}
+            for kind, source in sorted(sources, key=sources.get)
+            if (kind, source) in names
+        ]
 
-        if needed:
-            database = ActivityParameter.get(group=group).database
-            names = set()
-            for name in DatabaseParameter.static(database, only=needed):
-                names.add(name)
-                needed.remove(name)
-            if names:
-                chain.append({"kind": "database", "group": database, "names": names})
-        if needed:
-            names = set()
-            for name in ProjectParameter.static(only=needed):
-                names.add(name)
-                needed.remove(name)
-            if names:
-                chain.append({"kind": "project", "group": "project", "names": names})
+        needed = needed.difference(found)
         if needed:
             raise MissingName(
                 "The following variables aren't defined:\n{}".format("|".join(needed))
@@ -770,7 +960,7 @@ class ActivityParameter(ParameterBase):
         own_group = next((x for x in chain if x.get("group") == group), {})
         names = own_group.get("names", set())
         if include_order:
-            for new_group in Group.get(name=group).order:
+            for new_group in Group.get_cached(group).order:
                 order_group = next(
                     (x for x in chain if x.get("group") == new_group), {}
                 )
@@ -778,6 +968,7 @@ class ActivityParameter(ParameterBase):
         return True if name in names else False
 
     @staticmethod
+    @_recalc_context()
     def recalculate(group):
         """Recalculate all values for activity parameters in this group, and update their underlying `Activity` and `Exchange` values."""
         # Start by traversing and updating the list of dependencies
@@ -788,7 +979,8 @@ class ActivityParameter(ParameterBase):
 
         # Reset dependencies and dependency order
         if chain:
-            obj = Group.get(name=group)
+            GroupDependency.check_circular(group, [o["group"] for o in chain])
+            obj = Group.get_cached(group)
             obj.order = [o["group"] for o in chain if o["kind"] == "activity"]
             obj.save()
             GroupDependency.delete().where(GroupDependency.group == group).execute()
@@ -812,7 +1004,7 @@ class ActivityParameter(ParameterBase):
             mapping[row["kind"]].recalculate(row["group"])
 
         # Update activity parameter values
-        data = ActivityParameter.load(group)
+        data = ActivityParameter.load(group, data=False)
         static = {
             k: v
             for k, v in ActivityParameter._static_dependencies(group).items()
@@ -825,35 +1017,57 @@ class ActivityParameter(ParameterBase):
                     ActivityParameter.name == key,
                     ActivityParameter.group == group,
                 ).execute()
-            Group.get(name=group).freshen()
+            Group.get_cached(group).freshen()
             ActivityParameter.expire_downstream(group)
 
-        ActivityParameter.recalculate_exchanges(group)
+        # All parameters in a group belong to the same database
+        database = next(iter(data.values()))["database"] if data else None
+        ActivityParameter.recalculate_exchanges(group, database)
 
     @staticmethod
-    def recalculate_exchanges(group):
-        """Recalculate formulas for all parameterized exchanges in group ``group``."""
+    @_recalc_context()
+    def recalculate_exchanges(group, database=None):
+        """Recalculate formulas for all parameterized exchanges in group ``group``.
+
+        ``database`` is the database of the group's activities; it is looked up if not given."""
         if ActivityParameter.expired(group):
             return ActivityParameter.recalculate(group)
 
-        interpreter = Interpreter()
-        for k, v in ActivityParameter.static(group, full=True).items():
-            interpreter.symtable[k] = v
+        interpreter = _shared_interpreter(ActivityParameter.static(group, full=True))
+        symtable = dict(interpreter.symtable)
+        formulas = ParameterizedExchange.load(group)
+        # All exchanges share the same symbols, so exchanges with the same
+        # formula (e.g. a common per-unit factor) have the same amount
+        amounts = evaluate_formulas(formulas.values(), symtable, interpreter)
         # TODO: Remove uncertainty from exchanges?
-        for obj in ParameterizedExchange.select().where(
-            ParameterizedExchange.group == group
-        ):
-            exc = ExchangeDataset.get(id=obj.exchange)
-            exc.data["amount"] = interpreter(obj.formula)
-            exc.save()
+        with sqlite3_lci_db.atomic(), __exception_wrapper__:
+            updates = []
+            for batch in chunked(list(formulas), 500):
+                for exc_id, data in (
+                    ExchangeDataset.select(ExchangeDataset.id, ExchangeDataset.data)
+                    .where(ExchangeDataset.id << batch)
+                    .tuples()
+                ):
+                    data["amount"] = amounts[formulas[exc_id]]
+                    updates.append((ExchangeDataset.data.db_value(data), exc_id))
+            sqlite3_lci_db.db.connection().executemany(
+                "UPDATE exchangedataset SET data = ? WHERE id = ?", updates
+            )
 
-        databases.set_dirty(ActivityParameter.get(group=group).database)
+        databases.set_dirty(database or ActivityParameter._group_database(group))
 
-    def save(self, *args, **kwargs):
-        """Save this model instance"""
-        Group.get_or_create(name=self.group)[0].expire()
+    def save(self, *args, bulk=False, **kwargs):
+        """Save this model instance.
+
+        ``bulk`` skips expiring the activity group, for callers which expire it once themselves."""
+        if not bulk:
+            Group.expire_by_name(self.group)
         super(ActivityParameter, self).save(*args, **kwargs)
 
+    @staticmethod
+    def _group_name(row):
+        return row["group"]
+
     def is_deletable(self):
         """Perform a test to see if the current parameter can be deleted."""
         # First check own group
@@ -931,6 +1145,7 @@ class ActivityParameter(ParameterBase):
         for param_exc in exchanges:
             param_exc.save()
         Group.update(fresh=False).where(Group.name << groups).execute()
+        _GROUP_CACHE.clear()
 
     @classmethod
     def update_formula_database_parameter_name(cls, old, new):
@@ -982,6 +1197,7 @@ class ActivityParameter(ParameterBase):
         for param_exc in exchanges:
             param_exc.save()
         Group.update(fresh=False).where(Group.name << groups).execute()
+        _GROUP_CACHE.clear()
 
     @classmethod
     def update_formula_activity_parameter_name(cls, old, new, include_order=False):
@@ -1018,6 +1234,7 @@ class ActivityParameter(ParameterBase):
         for param_exc in exchanges:
             param_exc.save()
         Group.update(fresh=False).where(Group.name << groups).execute()
+        _GROUP_CACHE.clear()
 
     @classmethod
     def create_table(cls):
@@ -1039,7 +1256,8 @@ class ActivityParameter(ParameterBase):
                 "amount": self.amount,
             }
         )
-        obj.update(self.data)
+        if self.data:
+            obj.update(self.data)
         return obj
 
 
@@ -1055,7 +1273,7 @@ class ParameterizedExchange(Model):
         cls._meta.database.execute_sql(PE_INSERT_TRIGGER)
 
     def save(self, *args, **kwargs):
-        Group.get_or_create(name=self.group)[0].expire()
+        Group.expire_by_name(self.group)
         super(ParameterizedExchange, self).save(*args, **kwargs)
         # Push the changed formula to the Exchange.
         exc = ExchangeDataset.get_or_none(id=self.exchange)
@@ -1066,12 +1284,13 @@ class ParameterizedExchange(Model):
     @staticmethod
     def load(group):
         """Return dictionary of parameter data with names as keys and ``.dict()`` as values."""
-        return {
-            o.exchange: o.formula
-            for o in ParameterizedExchange.select().where(
-                ParameterizedExchange.group == group
+        return dict(
+            ParameterizedExchange.select(
+                ParameterizedExchange.exchange, ParameterizedExchange.formula
             )
-        }
+            .where(ParameterizedExchange.group == group)
+            .tuples()
+        )
 
     @staticmethod
     def recalculate(group):
@@ -1082,8 +1301,16 @@ class ParameterizedExchange(Model):
 class Group(Model):
     name = TextField(unique=True)
     fresh = BooleanField(default=True)
-    updated = DateTimeField(default=datetime.datetime.now)
-    order = PickleField(default=[])
+    # Set by sqlite (as are updates by the parameter triggers), so not
+    # available on instances until they are loaded from the database
+    updated = DateTimeField(constraints=[SQL("DEFAULT (datetime('now'))")])
+    order = JSONPickleField(default=list)
+
+    def __init__(self, *args, **kwargs):
+        super(Group, self).__init__(*args, **kwargs)
+        # Copy of ``order`` as loaded or last saved, so that unchanged
+        # orders aren't purged and serialized again on every save
+        self._saved_order = None if self.order is None else list(self.order)
 
     def expire(self):
         """Set ``fresh`` to ``False``"""
@@ -1095,15 +1322,57 @@ class Group(Model):
         self.fresh = True
         self.save()
 
+    @staticmethod
+    def expire_by_name(name):
+        """Set ``fresh`` to ``False`` for group ``name``, creating it if needed.
+
+        Uses a single upsert instead of loading and saving a ``Group`` instance."""
+        Group.insert(name=name, fresh=False).on_conflict(
+            conflict_target=[Group.name], update={Group.fresh: False}
+        ).execute()
+        _GROUP_CACHE.pop(name, None)
+
     def save(self, *args, **kwargs):
-        """Save this model instance. Will remove 'project' and database names from ``order``."""
-        self.purge_order()
-        super(Group, self).save(*args, **kwargs)
+        """Save this model instance. Will remove 'project' and database names from ``order``.
+
+        Existing groups only write changed fields, and ``order`` is only purged and written if it has changed. This keeps ``expire`` and ``freshen`` cheap, and means they don't overwrite ``updated`` as set by the parameter triggers."""
+        _GROUP_CACHE.pop(self.name, None)
+        if "order" in self._dirty or self.order != self._saved_order:
+            self.purge_order()
+            self._dirty.add("order")
+        if self.id is not None and not args and kwargs.get("only") is None:
+            if not self._dirty:
+                return False
+            kwargs["only"] = self.dirty_fields
+        result = super(Group, self).save(*args, **kwargs)
+        self._saved_order = None if self.order is None else list(self.order)
+        return result
+
+    @staticmethod
+    def get_cached(name):
+        """Get group ``name``. Cached during recalculations, as each recalculation looks up the same groups many times."""
+        if not _RECALC_DEPTH:
+            return Group.get(name=name)
+        try:
+            return _GROUP_CACHE[name]
+        except KeyError:
+            return _GROUP_CACHE.setdefault(name, Group.get(name=name))
 
     def purge_order(self):
         reserved = set(databases).union(set(["project"]))
         self.order = [x for x in self.order if x not in reserved]
 
+    @classmethod
+    def create_table(cls):
+        super(Group, cls).create_table()
+        schema = cls._meta.database.execute_sql(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'group_table'"
+        ).fetchone()[0]
+        if "DEFAULT" not in schema:
+            cls._meta.database.connection().executescript(
+                GROUP_UPDATED_DEFAULT_MIGRATION
+            )
+
     class Meta:
         table_name = "group_table"
 
@@ -1121,13 +1390,30 @@ class GroupDependency(Model):
             raise ValueError("`project` group can't have dependencies")
         elif self.group in databases and self.depends != "project":
             raise ValueError("Database groups can only depend on `project`")
+        GroupDependency.check_circular(self.group, [self.depends])
         super(GroupDependency, self).save(*args, **kwargs)
 
     @classmethod
     def create_table(cls):
         super(GroupDependency, cls).create_table()
-        cls._meta.database.execute_sql(GD_UPDATE_TRIGGER)
-        cls._meta.database.execute_sql(GD_INSERT_TRIGGER)
+        if GD_LEGACY_TRIGGERS:
+            cls._meta.database.execute_sql(GD_UPDATE_TRIGGER)
+            cls._meta.database.execute_sql(GD_INSERT_TRIGGER)
+        else:
+            for action in ("insert", "update"):
+                cls._meta.database.execute_sql(
+                    "DROP TRIGGER IF EXISTS gd_circular_{}".format(action)
+                )
+
+    @staticmethod
+    def check_circular(group, depends):
+        """Raise ``IntegrityError`` if any group in ``depends`` already depends on ``group``"""
+        if (
+            GroupDependency.select()
+            .where(GroupDependency.group << depends, GroupDependency.depends == group)
+            .exists()
+        ):
+            raise IntegrityError("Circular dependency")
 
 
 class ParameterManager:
@@ -1168,24 +1454,20 @@ class ParameterManager:
         def reformat(o):
             skipped = ("name", "amount", "formula")
             return [
-                nonempty(
-                    {
-                        "group": group,
-                        "database": o["database"],
-                        "code": o["code"],
-                        "name": p["name"],
-                        "formula": p.get("formula"),
-                        "amount": p.get("amount", 0),
-                        "data": {k: v for k, v in p.items() if k not in skipped},
-                    }
-                )
+                {
+                    "group": group,
+                    "database": o["database"],
+                    "code": o["code"],
+                    "name": p["name"],
+                    "formula": p.get("formula"),
+                    "amount": p.get("amount", 0),
+                    "data": {k: v for k, v in p.items() if k not in skipped},
+                }
                 for p in o.get("parameters", [])
             ]
 
         # Get formatted parameters
-        with self.db.atomic():
-            for row in reformat(activity):
-                ActivityParameter.create(**row)
+        ActivityParameter._bulk_create(reformat(activity))
 
         # Parameters are now "active", remove from `Activity`
         del activity["parameters"]
@@ -1343,9 +1625,7 @@ class ParameterManager:
             ProjectParameter.delete().where(
                 ProjectParameter.name << tuple(new)
             ).execute()
-            for idx in range(0, len(data), 100):
-                ProjectParameter.insert_many(data[idx : idx + 100]).execute()
-            Group.get_or_create(name="project")[0].expire()
+            ProjectParameter._bulk_create(data)
             ProjectParameter.recalculate()
 
     def new_database_parameters(self, data, database, overwrite=True):
@@ -1406,9 +1686,7 @@ class ParameterManager:
                 DatabaseParameter.database == database,
                 DatabaseParameter.name << tuple(new),
             ).execute()
-            for idx in range(0, len(data), 100):
-                DatabaseParameter.insert_many(data[idx : idx + 100]).execute()
-            Group.get_or_create(name=database)[0].expire()
+            DatabaseParameter._bulk_create(data)
             DatabaseParameter.recalculate(database)
 
     def new_activity_parameters(self, data, group, overwrite=True):
@@ -1478,9 +1756,7 @@ class ParameterManager:
             ActivityParameter.delete().where(
                 ActivityParameter.group == group, ActivityParameter.name << new
             ).execute()
-            for idx in range(0, len(data), 100):
-                ActivityParameter.insert_many(data[idx : idx + 100]).execute()
-            Group.get_or_create(name=group)[0].expire()
+            ActivityParameter._bulk_create(data)
             ActivityParameter.recalculate(group)
 
     def rename_project_parameter(self, parameter, new_name, update_dependencies=False):
@@ -1598,6 +1874,7 @@ class ParameterManager:
             parameter.save()
             self.recalculate()
 
+    @_recalc_context()
     def recalculate(self):
         """Recalculate all expired project, database, and activity parameters, as well as exchanges."""
         if ProjectParameter.expired():
@@ -1605,11 +1882,21 @@ class ParameterManager:
         for db in databases:
             if DatabaseParameter.expired(db):
                 DatabaseParameter.recalculate(db)
-        for obj in Group.select().where(Group.fresh == False):
+        # Load all groups into the recalculation cache with one query
+        groups = []
+        for obj in Group.select():
+            _GROUP_CACHE.setdefault(obj.name, obj)
             # Shouldn't be possible? Maybe concurrent access?
-            if obj.name in databases or obj.name == "project":
-                continue
-            ActivityParameter.recalculate(obj.name)
+            if obj.name not in databases and obj.name != "project":
+                groups.append(obj.name)
+        # Upstream groups come first, so each group is recalculated once,
+        # including groups expired by recalculating their upstream groups
+        edges = GroupDependency.select(
+            GroupDependency.group, GroupDependency.depends
+        ).tuples()
+        for group in topological_order(groups, edges):
+            if ActivityParameter.expired(group):
+                ActivityParameter.recalculate(group)
 
     def __len__(self):
         return (
@@ -1625,22 +1912,303 @@ class ParameterManager:
 parameters = ParameterManager()
 
 
+def topological_order(nodes, edges):
+    """Order ``nodes`` so that each node comes after the nodes it depends on.
+
+    ``edges`` is an iterable of ``(node, depends)`` tuples; edges to nodes not in ``nodes`` are ignored."""
+    upstream = {node: set() for node in nodes}
+    downstream = collections.defaultdict(set)
+    for node, depends in edges:
+        if node in upstream and depends in upstream:
+            upstream[node].add(depends)
+            downstream[depends].add(node)
+
+    queue = collections.deque(sorted(k for k, v in upstream.items() if not v))
+    result = []
+    while queue:
+        node = queue.popleft()
+        result.append(node)
+        for other in sorted(downstream[node]):
+            upstream[other].discard(node)
+            if not upstream[other]:
+                queue.append(other)
+    # Cycles are forbidden, but don't silently drop nodes if one exists
+    result.extend(sorted(set(upstream).difference(result)))
+    return result
+
+
+"""Shared interpreter for parsing and evaluating formulas, and the symbols ``asteval`` defines itself"""
+_INTERPRETER = Interpreter()
+_BUILTIN_SYMTABLE = dict(_INTERPRETER.symtable)
+_BUILTINS = frozenset(_BUILTIN_SYMTABLE)
+
+
+def _shared_interpreter(symbols):
+    """Return the shared interpreter, with only the ``asteval`` symbols and ``symbols`` defined.
+
+    The whole symbol table is reset, as formulas can also overwrite ``asteval`` symbols."""
+    _INTERPRETER.symtable.clear()
+    _INTERPRETER.symtable.update(_BUILTIN_SYMTABLE)
+    _INTERPRETER.symtable.update(symbols)
+    return _INTERPRETER
+
+
+"""Names used by each formula, keyed by formula text. Cleared when it grows past ``_FORMULA_NAMES_CACHE_SIZE``."""
+_FORMULA_NAMES_CACHE = {}
+_FORMULA_NAMES_CACHE_SIZE = 4096
+
+
+def _parse_formula_names(formula):
+    """Return the names used in ``formula``, using ``asteval`` parsing and error handling."""
+    nf = asteval.NameFinder()
+    nf.generic_visit(_INTERPRETER.parse(formula))
+    return frozenset(nf.names)
+
+
+def _parse_formulas_names(formulas):
+    """Return ``{formula: names}`` for ``formulas``, parsing all single-line formulas in one pass.
+
+    Each formula becomes one line ``_=(formula)`` of a single module. A formula's names are only taken from this module if its expression spans exactly its own text on its own line, so formulas which are invalid on their own (e.g. ``a)(b``) can't be combined with their neighbours. Assignment and generator expressions can be valid only inside the added parentheses (e.g. ``x := a``). All other formulas, including any with these expressions, are parsed one by one."""
+    single = [f for f in formulas if not isinstance(f, str) or "\n" in f or "\r" in f]
+    batch = [
+        f for f in formulas if isinstance(f, str) and "\n" not in f and "\r" not in f
+    ]
+    result = {}
+    try:
+        tree = (
+            ast.parse("\n".join("_=({})".format(f) for f in batch)) if batch else None
+        )
+    except SyntaxError:
+        single.extend(batch)
+        tree = None
+    if tree is not None:
+        lines = {stmt.lineno: stmt for stmt in tree.body}
+        for index, formula in enumerate(batch, start=1):
+            stmt = lines.get(index)
+            if (
+                isinstance(stmt, ast.Assign)
+                and stmt.end_lineno == index
+                and stmt.value.lineno == index
+                and stmt.value.col_offset == 3
+                and stmt.value.end_col_offset == 3 + len(formula.encode("utf-8"))
+                and not any(
+                    isinstance(node, (ast.NamedExpr, ast.GeneratorExp))
+                    for node in ast.walk(stmt.value)
+                )
+            ):
+                nf = asteval.NameFinder()
+                nf.generic_visit(stmt.value)
+                result[formula] = frozenset(nf.names)
+            else:
+                single.append(formula)
+    for formula in single:
+        result[formula] = _parse_formula_names(formula)
+    return result
+
+
+def _formula_names(formulas):
+    """Return ``{formula: names}`` for ``formulas``. Cached, as the same formulas are parsed on every recalculation."""
+    result, missing = {}, []
+    for formula in formulas:
+        if formula in result:
+            continue
+        try:
+            result[formula] = _FORMULA_NAMES_CACHE[formula]
+        except KeyError:
+            result[formula] = None
+            missing.append(formula)
+    if missing:
+        parsed = _parse_formulas_names(missing)
+        if len(_FORMULA_NAMES_CACHE) + len(parsed) > _FORMULA_NAMES_CACHE_SIZE:
+            _FORMULA_NAMES_CACHE.clear()
+        _FORMULA_NAMES_CACHE.update(parsed)
+        result.update(parsed)
+    return result
+
+
 def get_new_symbols(data, context=None):
-    interpreter = asteval.Interpreter()
-    BUILTIN_SYMBOLS = set(interpreter.symtable).union(set(context or set()))
-    found = set()
+    formulas = []
     for ds in data:
         if isinstance(ds, str):
-            formula = ds
+            formulas.append(ds)
         elif "formula" in ds:
-            formula = ds["formula"]
-        else:
-            continue
+            formulas.append(ds["formula"])
+    found = set()
+    for names in _formula_names(formulas).values():
+        found.update(names)
+    return found.difference(_BUILTINS).difference(context or set())
+
+
+"""Compiled formulas as ``(code, names)``, keyed by formula text. ``None`` means the formula is left to ``asteval``."""
+_FORMULA_CODE_CACHE = {}
+_SAFE_GLOBALS = {"__builtins__": {}}
+_SAFE_NODES = (
+    ast.Expression,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.BoolOp,
+    ast.Compare,
+    ast.IfExp,
+    ast.Call,
+    ast.Name,
+    ast.Load,
+    ast.Constant,
+    ast.unaryop,
+    ast.boolop,
+    ast.cmpop,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.FloorDiv,
+    ast.Mod,
+    ast.Pow,
+)
+"""Functions which formulas can call in compiled code. They only take and return numbers, so they can't build the large strings or lists which ``asteval`` guards against."""
+_SAFE_FUNCTIONS = frozenset(
+    {
+        "abs",
+        "min",
+        "max",
+        "round",
+        "int",
+        "float",
+        "sqrt",
+        "exp",
+        "expm1",
+        "log",
+        "log10",
+        "log2",
+        "log1p",
+        "sin",
+        "cos",
+        "tan",
+        "arcsin",
+        "arccos",
+        "arctan",
+        "sinh",
+        "cosh",
+        "tanh",
+        "floor",
+        "ceil",
+    }
+)
+
 
-        nf = asteval.NameFinder()
-        nf.generic_visit(interpreter.parse(formula))
-        found.update(set(nf.names))
-    return found.difference(BUILTIN_SYMBOLS)
+def _is_plain_arithmetic(tree):
+    """Test if ``tree`` only uses constructs which are as safe under ``eval`` as under ``asteval``.
+
+    Allows numeric constants, names, calls of ``_SAFE_FUNCTIONS`` without keywords, and arithmetic, boolean, and comparison operators. Exponents must be numeric constants no larger than those ``asteval`` allows."""
+    for node in ast.walk(tree):
+        if not isinstance(node, _SAFE_NODES):
+            return False
+        elif isinstance(node, ast.Constant) and not isinstance(
+            node.value, (int, float, complex)
+        ):
+            return False
+        elif isinstance(node, ast.Call) and not (
+            isinstance(node.func, ast.Name) and node.func.id in _SAFE_FUNCTIONS
+        ):
+            return False
+        elif isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+            if not (
+                isinstance(node.right, ast.Constant)
+                and isinstance(node.right.value, (int, float))
+                and abs(node.right.value) <= MAX_EXPONENT
+            ):
+                return False
+    return True
+
+
+def _compile_formula(formula):
+    """Compile ``formula`` once, returning ``(code, names)`` or ``None``.
+
+    ``formula`` is parsed as a statement like ``asteval`` does, so that e.g. leading whitespace is an error in both."""
+    try:
+        return _FORMULA_CODE_CACHE[formula]
+    except KeyError:
+        pass
+    tree = None
+    if len(formula) <= _INTERPRETER.max_statement_length:
+        try:
+            module = ast.parse(formula)
+        except SyntaxError:
+            module = None
+        if (
+            module is not None
+            and len(module.body) == 1
+            and isinstance(module.body[0], ast.Expr)
+        ):
+            tree = ast.Expression(body=module.body[0].value)
+    if tree is not None and _is_plain_arithmetic(tree):
+        code = compile(tree, "<bw2param>", "eval")
+        compiled = (code, frozenset(code.co_names))
+    else:
+        compiled = None
+    return _FORMULA_CODE_CACHE.setdefault(formula, compiled)
+
+
+def evaluate_formula(formula, symtable, interpreter):
+    """Evaluate ``formula`` with the variables in ``symtable``.
+
+    Simple formulas are compiled to Python bytecode once and cached; everything else, including formulas which raise errors, is evaluated by ``interpreter``, which should have the same symbols as ``symtable``."""
+    compiled = _compile_formula(formula)
+    if compiled is not None and symtable.keys() >= compiled[1]:
+        try:
+            return eval(compiled[0], _SAFE_GLOBALS, symtable)
+        except Exception:
+            pass
+    return interpreter(formula)
+
+
+"""Compiled expressions for evaluating several simple formulas at once, keyed by the tuple of formulas. Cleared when it grows past ``_FORMULA_NAMES_CACHE_SIZE``."""
+_FORMULAS_CODE_CACHE = {}
+
+
+def _compile_formulas(formulas):
+    """Compile the tuple of simple ``formulas`` into one expression, which evaluates to the tuple of their values. Returns ``(code, names)`` or ``None``."""
+    try:
+        return _FORMULAS_CODE_CACHE[formulas]
+    except KeyError:
+        pass
+    # Newlines keep each formula, including any trailing comment, separate
+    source = "({})".format("".join("\n{}\n,".format(f) for f in formulas))
+    try:
+        tree = ast.parse(source, mode="eval")
+    except SyntaxError:
+        tree = None
+    if (
+        tree is not None
+        and isinstance(tree.body, ast.Tuple)
+        and len(tree.body.elts) == len(formulas)
+    ):
+        compiled = (
+            compile(tree, "<bw2param>", "eval"),
+            frozenset().union(*(_compile_formula(f)[1] for f in formulas)),
+        )
+    else:
+        compiled = None
+    if len(_FORMULAS_CODE_CACHE) >= _FORMULA_NAMES_CACHE_SIZE:
+        _FORMULAS_CODE_CACHE.clear()
+    return _FORMULAS_CODE_CACHE.setdefault(formulas, compiled)
+
+
+def evaluate_formulas(formulas, symtable, interpreter):
+    """Evaluate each of ``formulas`` with the variables in ``symtable``. Returns ``{formula: value}``.
+
+    Simple formulas are evaluated together by a single ``eval`` of one compiled expression. If that raises, for example because one formula divides by zero, each formula is evaluated by ``evaluate_formula`` instead. This can evaluate simple formulas twice, which is harmless as they only call functions of ``_SAFE_FUNCTIONS``, which have no side effects."""
+    formulas = set(formulas)
+    simple = tuple(sorted(f for f in formulas if _compile_formula(f) is not None))
+    result = {}
+    compiled = _compile_formulas(simple) if len(simple) > 1 else None
+    if compiled is not None and symtable.keys() >= compiled[1]:
+        try:
+            result = dict(zip(simple, eval(compiled[0], _SAFE_GLOBALS, symtable)))
+        except Exception:
+            pass
+    for formula in formulas.difference(result):
+        result[formula] = evaluate_formula(formula, symtable, interpreter)
+    return result
 
 
 def alter_parameter_formula(parameter, old, new):
@@ -1,5 +1,6 @@
 import json
 import pickle
+import sqlite3
 
 from peewee import BlobField, SqliteDatabase, TextField
 
@@ -66,6 +67,40 @@ class JSONField(TextField):
         return json.loads(value)
 
 
+class JSONPickleField(TextField):
+    """Compact JSON field which falls back to pickle for values JSON can't store exactly.
+
+    Values are stored as JSON text when they survive a JSON round trip unchanged, and as pickle blobs otherwise. Both are read, so existing ``PickleField`` columns can switch to this field without rewriting their data. JSON text can be queried with sqlite's JSON1 functions, e.g. ``json_extract(data, '$.minimum')``."""
+
+    # Non-finite floats aren't valid JSON for sqlite, so raise and are pickled
+    _encoder = json.JSONEncoder(ensure_ascii=False, allow_nan=False)
+    _scalars = (str, int, float, bool, type(None))
+
+    def db_value(self, value):
+        try:
+            text = self._encoder.encode(value)
+            # sqlite can't store strings with lone surrogates
+            text.encode("utf-8")
+        except (TypeError, ValueError):
+            text = None
+        if text is not None and (self._is_flat(value) or json.loads(text) == value):
+            return text
+        return sqlite3.Binary(pickle.dumps(value, protocol=4))
+
+    def _is_flat(self, value):
+        """Test if ``value`` is a dictionary of strings and numbers, which always survives a JSON round trip. Avoids decoding the JSON again for the usual parameter metadata."""
+        return type(value) is dict and all(
+            type(k) is str and type(v) in self._scalars for k, v in value.items()
+        )
+
+    def python_value(self, value):
+        if value is None:
+            return None
+        elif isinstance(value, str):
+            return json.loads(value)
+        return pickle.loads(bytes(value))
+
+
 class TupleJSONField(JSONField):
     def python_value(self, value):
         if value is None:
@@ -87,6 +87,9 @@ DROP TABLE ED_old;
 COMMIT;
 """
 
+SELECT_PICKLED_PARAMETER_DATA = """SELECT id, "{column}" FROM {table} WHERE typeof("{column}") = 'blob'"""
+UPDATE_PARAMETER_DATA = """UPDATE {table} SET "{column}" = ? WHERE id = ?"""
+
 
 class Updates:
     UPDATES = {
@@ -115,6 +118,11 @@ class Updates:
             "automatic": True,
             "explanation": "bw2data 4.0 release requires migrations filename changes",
         },
+        "4.0 parameter data as JSON": {
+            "method": "parameter_data_to_json_40",
+            "automatic": True,
+            "explanation": "Store parameter metadata and group orders as JSON instead of pickles",
+        },
     }
 
     @classmethod
@@ -234,6 +242,31 @@ class Updates:
             )
             current.replace(target)
 
+    @classmethod
+    def parameter_data_to_json_40(cls):
+        """Rewrite pickled parameter ``data`` and group ``order`` values as JSON, where this is lossless."""
+        from .parameters import ActivityParameter, DatabaseParameter, Group
+        from .parameters import ProjectParameter, parameters
+
+        with parameters.db.atomic():
+            for model, field in (
+                (ProjectParameter, ProjectParameter.data),
+                (DatabaseParameter, DatabaseParameter.data),
+                (ActivityParameter, ActivityParameter.data),
+                (Group, Group.order),
+            ):
+                names = {"table": model._meta.table_name, "column": field.column_name}
+                rows = [
+                    (field.db_value(pickle.loads(bytes(value))), id_)
+                    for id_, value in parameters.db.execute_sql(
+                        SELECT_PICKLED_PARAMETER_DATA.format(**names)
+                    )
+                ]
+                parameters.db.db.connection().executemany(
+                    UPDATE_PARAMETER_DATA.format(**names),
+                    [row for row in rows if isinstance(row[0], str)],
+                )
+
     @classmethod
     def _reprocess_all(cls):
         objects = [
@@ -1,11 +1,17 @@
+import datetime
+import math
+import pickle
 import re
+import sqlite3
+import sys
 import time
 
 import pytest
+from asteval import Interpreter
 from bw2parameters.errors import MissingName
-from peewee import IntegrityError
+from peewee import IntegrityError, OperationalError
 
-from bw2data import Database, get_activity, parameters
+from bw2data import Database, Updates, databases, get_activity, parameters
 from bw2data.parameters import (
     ActivityParameter,
     DatabaseParameter,
@@ -13,7 +19,17 @@ from bw2data.parameters import (
     GroupDependency,
     ParameterizedExchange,
     ProjectParameter,
+    _GROUP_CACHE,
+    _compile_formula,
+    _parse_formulas_names,
+    _recalc_context,
+    _shared_interpreter,
+    evaluate_formula,
+    evaluate_formulas,
+    get_new_symbols,
+    parameter_sort_key,
     parameters,
+    topological_order,
 )
 from bw2data.tests import bw2test
 
@@ -46,6 +62,19 @@ def test_project_parameter_autocreate_group():
     assert not Group.get(name="project").fresh
 
 
+@bw2test
+def test_project_parameter_save_bulk():
+    ProjectParameter(name="foo", amount=3.14).save(bulk=True)
+    assert not Group.select().count()
+    ProjectParameter._bulk_create([{"name": "bar", "amount": 1, "data": {}}])
+    assert ProjectParameter.select().count() == 2
+    assert not Group.get(name="project").fresh
+    assert ProjectParameter.get(name="bar").amount == 1
+    assert ProjectParameter.get(name="bar").formula is None
+    with pytest.raises(IntegrityError):
+        ProjectParameter._bulk_create([{"name": "bar", "amount": 2}])
+
+
 @bw2test
 def test_expire_downstream():
     Group.create(fresh=True, name="A")
@@ -68,6 +97,13 @@ def test_project_parameters_ordering():
         formula="2 * foo",
     )
     assert another < obj
+    third = ProjectParameter.create(name="Baz", amount=1)
+    assert sorted([obj, third, another], key=parameter_sort_key) == [
+        another,
+        third,
+        obj,
+    ]
+    assert sorted([obj, third, another]) == [another, third, obj]
 
 
 @bw2test
@@ -95,6 +131,20 @@ def test_project_parameters_load():
     assert ProjectParameter.load() == expected
     assert ProjectParameter.load("project") == expected
     assert ProjectParameter.load("foo") == expected
+    expected = {
+        "foo": {"amount": 3.14},
+        "bar": {"formula": "2 * foo"},
+    }
+    assert ProjectParameter.load(data=False) == expected
+
+
+@bw2test
+def test_project_parameters_default_data_not_shared():
+    first = ProjectParameter(name="foo", amount=1)
+    second = ProjectParameter(name="bar", amount=2)
+    first.data["baz"] = 3
+    assert second.data == {}
+    assert Group(name="A").order is not Group(name="B").order
 
 
 @bw2test
@@ -824,6 +874,25 @@ def test_activity_parameter_load():
         }
     }
     assert ActivityParameter.load("A") == expected
+    del expected["F"]["foo"]
+    assert ActivityParameter.load("A", data=False) == expected
+
+
+@bw2test
+def test_parameters_load_matches_dict():
+    ProjectParameter.create(name="foo", amount=1, data={"bar": None})
+    DatabaseParameter.create(database="B", name="foo", formula="2", data={})
+    ActivityParameter.create(group="A", database="B", code="C", name="foo")
+    for model, group in (
+        (ProjectParameter, "project"),
+        (DatabaseParameter, "B"),
+        (ActivityParameter, "A"),
+    ):
+        expected = {}
+        for obj in model.select():
+            dct = obj.dict
+            expected[dct.pop("name")] = dct
+        assert model.load(group) == expected
 
 
 def test_activity_parameter_static(chain):
@@ -839,6 +908,21 @@ def test_activity_parameter_static(chain):
     assert ActivityParameter.static("A", full=True, only=["foo", "bar"]) == expected
 
 
+@bw2test
+def test_static_uses_covering_indexes():
+    for model, where in (
+        (ProjectParameter, ""),
+        (DatabaseParameter, "WHERE database = 'B'"),
+        (ActivityParameter, """WHERE "group" = 'A'"""),
+    ):
+        plan = parameters.db.execute_sql(
+            "EXPLAIN QUERY PLAN SELECT name, amount FROM {} {}".format(
+                model._meta.table_name, where
+            )
+        ).fetchall()
+        assert "COVERING INDEX" in plan[0][-1]
+
+
 @bw2test
 def test_activity_parameter_recalculate_shortcut():
     assert not ActivityParameter.recalculate("A")
@@ -857,6 +941,33 @@ def test_activity_parameter_dependency_chain(chain):
     assert ActivityParameter.dependency_chain("A") == expected
 
 
+@pytest.mark.skipif(
+    not hasattr(sqlite3.Connection, "setlimit"), reason="requires Python 3.11"
+)
+@bw2test
+def test_activity_parameter_dependency_chain_many_names():
+    names = ["p{}".format(i) for i in range(500)]
+    parameters.new_project_parameters([{"name": n, "amount": 1} for n in names])
+    Database("B").register()
+    Group.create(name="A", order=[])
+    for i in range(10):
+        ActivityParameter.create(
+            group="A",
+            database="B",
+            code="C",
+            name="D{}".format(i),
+            formula=" + ".join(names[i * 50 : (i + 1) * 50]),
+        )
+    # Default limit of sqlite before 3.32
+    connection = parameters.db.db.connection()
+    limit = connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+    try:
+        expected = [{"kind": "project", "group": "project", "names": set(names)}]
+        assert ActivityParameter.dependency_chain("A") == expected
+    finally:
+        connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, limit)
+
+
 def test_activity_parameter_dependency_chain_missing(chain):
     """Use unknown parameter 'K' in formula to test for MissingName error."""
     ActivityParameter.create(
@@ -1046,6 +1157,95 @@ def test_activity_parameter_recalculate_exchanges():
         assert exc.amount == 9
 
 
+@bw2test
+def test_recalculate_exchanges_multiple_exchanges():
+    db = Database("example")
+    db.register()
+    a = db.new_activity(code="A", name="An activity")
+    a.save()
+    b = db.new_activity(code="B", name="Another activity")
+    b.save()
+    a.new_exchange(amount=0, input=b, type="technosphere", formula="foo * 2").save()
+    a.new_exchange(amount=0, input=a, type="production", formula="foo + 1").save()
+    a.new_exchange(amount=0, input=b, type="technosphere", formula="foo * 2").save()
+
+    activity_data = [{"name": "foo", "amount": 3, "database": "example", "code": "A"}]
+    parameters.new_activity_parameters(activity_data, "my group")
+    parameters.add_exchanges_to_group("my group", a)
+    ActivityParameter.recalculate_exchanges("my group")
+
+    assert sorted(exc["amount"] for exc in a.exchanges()) == [4, 6, 6]
+    assert all(exc["original_amount"] == 0 for exc in a.exchanges())
+
+    databases["example"]["dirty"] = False
+    databases.flush()
+    ActivityParameter.recalculate_exchanges("my group", "example")
+    assert databases["example"]["dirty"]
+    assert ActivityParameter._group_database("my group") == "example"
+
+
+def test_evaluate_formula_compiled_and_fallback():
+    interpreter = Interpreter()
+    interpreter.symtable.update({"foo": 4.0, "bar": 2.0})
+    symtable = dict(interpreter.symtable)
+    assert _compile_formula("sqrt(foo) * bar + 1") is not None
+    assert evaluate_formula("sqrt(foo) * bar + 1", symtable, interpreter) == 5
+    # Attribute access isn't compiled, but still works through ``asteval``
+    assert _compile_formula("foo.real") is None
+    assert evaluate_formula("foo.real", symtable, interpreter) == 4
+    # Errors are handled by ``asteval``
+    assert evaluate_formula("foo / 0", symtable, interpreter) is None
+    assert evaluate_formula("missing + 1", symtable, interpreter) is None
+
+
+def test_evaluate_formula_matches_asteval():
+    interpreter = Interpreter()
+    interpreter.symtable.update({"a": 2.0})
+    symtable = dict(interpreter.symtable)
+    for formula in (
+        "str(1) * 10**8",
+        "chr(65) * 3",
+        " 2 * a",
+        "\t2 * a",
+        "sqrt(a) * 2 # comment",
+        "max(a, 3)",
+        "a; a",
+    ):
+        reference = Interpreter()
+        reference.symtable.update({"a": 2.0})
+        assert evaluate_formula(formula, symtable, interpreter) == reference(formula)
+    # Only numeric functions are compiled
+    assert _compile_formula("str(1) * 10**8") is None
+    assert _compile_formula(" 2 * a") is None
+
+
+def test_shared_interpreter_reset():
+    interpreter = _shared_interpreter({"foo": 4.0})
+    interpreter("sqrt = 1")
+    interpreter("bar = 2")
+    interpreter = _shared_interpreter({"baz": 9.0})
+    assert "foo" not in interpreter.symtable
+    assert "bar" not in interpreter.symtable
+    assert interpreter("sqrt(baz)") == 3
+
+
+def test_evaluate_formulas_together_and_fallback():
+    interpreter = Interpreter()
+    interpreter.symtable.update({"foo": 4.0, "bar": 2.0})
+    symtable = dict(interpreter.symtable)
+    formulas = ["foo * bar", "sqrt(foo) # comment", "foo - bar", "foo * bar"]
+    expected = {"foo * bar": 8, "sqrt(foo) # comment": 2, "foo - bar": 2}
+    assert evaluate_formulas(formulas, symtable, interpreter) == expected
+    # One failing formula doesn't affect the others
+    formulas = ["foo * bar", "foo / 0", "foo.real"]
+    expected = {"foo * bar": 8, "foo / 0": None, "foo.real": 4}
+    assert evaluate_formulas(formulas, symtable, interpreter) == expected
+    # Same results as ``asteval``
+    formulas = [" 2 * foo", "foo", "chr(65) * 10**8"]
+    expected = {" 2 * foo": None, "foo": 4, "chr(65) * 10**8": None}
+    assert evaluate_formulas(formulas, symtable, interpreter) == expected
+
+
 @bw2test
 def test_pe_no_activities_parameter_group_error():
     db = Database("example")
@@ -1370,12 +1570,69 @@ def test_group_purging():
     Database("B").register()
     o = Group.create(name="one", order=["C", "project", "B", "D", "A"])
     expected = ["C", "D"]
-    assert o.updated
+    assert Group.get(name="one").updated
     assert o.fresh
     assert o.order == expected
     assert Group.get(name="one").order == expected
 
 
+@bw2test
+def test_group_expire_by_name():
+    Group.expire_by_name("foo")
+    assert not Group.get(name="foo").fresh
+    assert Group.get(name="foo").order == []
+    Group.get(name="foo").freshen()
+    Group.expire_by_name("foo")
+    assert not Group.get(name="foo").fresh
+    assert Group.select().count() == 1
+
+
+@bw2test
+def test_group_get_cached():
+    Group.create(name="foo")
+    assert Group.get_cached("foo") is not Group.get_cached("foo")
+    with _recalc_context():
+        obj = Group.get_cached("foo")
+        assert Group.get_cached("foo") is obj
+        with _recalc_context():
+            assert Group.get_cached("foo") is obj
+        assert Group.get_cached("foo") is obj
+        Group.expire_by_name("foo")
+        assert Group.get_cached("foo") is not obj
+        assert not Group.get_cached("foo").fresh
+    assert not _GROUP_CACHE
+    with pytest.raises(Group.DoesNotExist):
+        with _recalc_context():
+            Group.get_cached("bar")
+
+
+@bw2test
+def test_group_freshen_keeps_updated():
+    obj = Group.create(name="foo", fresh=False)
+    Group.update(updated=datetime.datetime(2000, 1, 1)).execute()
+    obj.freshen()
+    assert Group.get(name="foo").fresh
+    assert Group.get(name="foo").updated == datetime.datetime(2000, 1, 1)
+
+
+@bw2test
+def test_group_save_only_changed_fields():
+    Database("A").register()
+    obj = Group.create(name="foo", order=["bar"])
+    parameters.db.execute_sql(
+        "UPDATE group_table SET \"order\" = '[\"baz\"]' WHERE name = 'foo'"
+    )
+    obj.expire()
+    assert not Group.get(name="foo").fresh
+    assert Group.get(name="foo").order == ["baz"]
+
+    obj = Group.get(name="foo")
+    obj.order.extend(["A", "bar"])
+    obj.save()
+    assert Group.get(name="foo").order == ["baz", "bar"]
+    assert obj.save() is False
+
+
 ######################
 ### Group dependencies
 ######################
@@ -1412,6 +1669,23 @@ def test_group_dependency_circular():
     GroupDependency.create(group="foo", depends="bar")
     with pytest.raises(IntegrityError):
         GroupDependency.create(group="bar", depends="foo")
+    assert not parameters.db.execute_sql(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'gd_%'"
+    ).fetchall()
+
+
+@bw2test
+def test_group_dependency_circular_recalculate():
+    Database("B").register()
+    ActivityParameter.create(group="A", database="B", code="C", name="D", amount=1)
+    ActivityParameter.create(group="E", database="B", code="F", name="G", amount=2)
+    GroupDependency.create(group="A", depends="E")
+    ActivityParameter.create(group="E", database="B", code="H", name="I", formula="D")
+    g = Group.get(name="E")
+    g.order = ["A"]
+    g.save()
+    with pytest.raises(IntegrityError):
+        ActivityParameter.recalculate("E")
 
 
 @bw2test
@@ -1992,3 +2266,204 @@ def test_parameters_save_keep_changed_exchange_amount():
     for exc in a.exchanges():
         assert exc["amount"] == 12
         assert "original_amount" in exc
+
+
+def test_parse_formulas_names():
+    formulas = ["a + b", "(c)", "sqrt(d) ** 2", "é * f", "g\n+ h", "2"]
+    assert _parse_formulas_names(formulas) == {
+        "a + b": {"a", "b"},
+        "(c)": {"c"},
+        "sqrt(d) ** 2": {"sqrt", "d"},
+        "é * f": {"é", "f"},
+        "g\n+ h": {"g", "h"},
+        "2": set(),
+    }
+    # Formulas can't be combined with their neighbours
+    assert _parse_formulas_names(["x", "a #", "y"]) == {
+        "x": {"x"},
+        "a #": {"a"},
+        "y": {"y"},
+    }
+    assert _parse_formulas_names(["z", "(x := a)"]) == {
+        "z": {"z"},
+        "(x := a)": {"x", "a"},
+    }
+    for bad in ("a)(b", "1); (2", "x := a", "x for x in a"):
+        with pytest.raises(SyntaxError):
+            _parse_formulas_names(["x", bad, "y"])
+
+
+def test_get_new_symbols():
+    data = [{"formula": "sqrt(foo) + bar * 2"}, {"amount": 1}, "baz / pi", "foo + 1"]
+    assert get_new_symbols(data) == {"foo", "bar", "baz"}
+    assert get_new_symbols(data, context={"bar"}) == {"foo", "baz"}
+    assert get_new_symbols([]) == set()
+
+
+@bw2test
+def test_parameter_data_json_storage():
+    ProjectParameter.create(name="foo", amount=1, data={"uncertainty type": 0})
+    ProjectParameter.create(name="bar", amount=2, data={"loc": (1, 2)})
+    SQL = "SELECT typeof(data), json_valid(data) FROM projectparameter WHERE name = ?"
+    assert parameters.db.execute_sql(SQL, ("foo",)).fetchone() == ("text", 1)
+    assert parameters.db.execute_sql(SQL, ("bar",)).fetchone()[0] == "blob"
+    assert ProjectParameter.get(name="foo").data == {"uncertainty type": 0}
+    assert ProjectParameter.get(name="bar").data == {"loc": (1, 2)}
+    # Values which change in a JSON round trip are pickled
+    ProjectParameter.create(name="baz", amount=3, data={1: 2, "scale": 0.5})
+    ProjectParameter.create(name="qux", amount=4, data={"scale": float("nan")})
+    assert parameters.db.execute_sql(SQL, ("baz",)).fetchone()[0] == "blob"
+    assert parameters.db.execute_sql(SQL, ("qux",)).fetchone()[0] == "blob"
+    assert ProjectParameter.get(name="baz").data == {1: 2, "scale": 0.5}
+    assert math.isnan(ProjectParameter.get(name="qux").data["scale"])
+    data = {"uncertainty type": 4, "minimum": 0, "maximum": float("inf")}
+    ProjectParameter.create(name="corge", amount=6, data=data)
+    assert parameters.db.execute_sql(SQL, ("corge",)).fetchone()[0] == "blob"
+    assert ProjectParameter.get(name="corge").data == data
+    # All JSON text can be queried
+    assert parameters.db.execute_sql(
+        "SELECT json_extract(data, '$.minimum') FROM projectparameter "
+        "WHERE typeof(data) = 'text'"
+    ).fetchall()
+    ProjectParameter.create(name="quux", amount=5, data={"comment": "\ud800"})
+    assert parameters.db.execute_sql(SQL, ("quux",)).fetchone()[0] == "blob"
+    assert ProjectParameter.get(name="quux").data == {"comment": "\ud800"}
+
+
+@bw2test
+def test_parameter_data_to_json_update():
+    ProjectParameter.create(name="foo", amount=1)
+    ProjectParameter.create(name="bar", amount=2)
+    Group.create(name="A", order=["B"])
+    for name, value in (("foo", {"minimum": 0}), ("bar", {"loc": (1, 2)})):
+        parameters.db.execute_sql(
+            "UPDATE projectparameter SET data = ? WHERE name = ?",
+            (pickle.dumps(value, protocol=4), name),
+        )
+    parameters.db.execute_sql(
+        "UPDATE group_table SET \"order\" = ? WHERE name = 'A'",
+        (pickle.dumps(["B"], protocol=4),),
+    )
+
+    Updates.parameter_data_to_json_40()
+
+    SQL = "SELECT typeof(data) FROM projectparameter WHERE name = ?"
+    assert parameters.db.execute_sql(SQL, ("foo",)).fetchone()[0] == "text"
+    assert parameters.db.execute_sql(SQL, ("bar",)).fetchone()[0] == "blob"
+    assert ProjectParameter.get(name="foo").data == {"minimum": 0}
+    assert ProjectParameter.get(name="bar").data == {"loc": (1, 2)}
+    SQL = "SELECT typeof(\"order\") FROM group_table WHERE name = 'A'"
+    assert parameters.db.execute_sql(SQL).fetchone()[0] == "text"
+    assert Group.get(name="A").order == ["B"]
+
+
+def test_topological_order():
+    edges = [("b", "a"), ("c", "b"), ("c", "a"), ("d", "project"), ("a", "z")]
+    assert topological_order(["c", "b", "a", "d"], edges) == ["a", "d", "b", "c"]
+    assert topological_order([], edges) == []
+    assert topological_order(["a", "b"], [("a", "b"), ("b", "a")]) == ["a", "b"]
+
+
+@bw2test
+def test_parameters_recalculate_downstream_groups():
+    Database("B").register()
+    parameters.new_activity_parameters(
+        [{"name": "up", "amount": 2, "database": "B", "code": "C"}], "upstream"
+    )
+    Group.create(name="downstream", order=["upstream"])
+    parameters.new_activity_parameters(
+        [{"name": "down", "formula": "up * 3", "database": "B", "code": "D"}],
+        "downstream",
+    )
+    assert ActivityParameter.get(name="down").amount == 6
+
+    ActivityParameter.update(formula="4").where(
+        ActivityParameter.name == "up"
+    ).execute()
+    Group.get(name="upstream").expire()
+    assert Group.get(name="downstream").fresh
+    parameters.recalculate()
+    assert ActivityParameter.get(name="up").amount == 4
+    assert ActivityParameter.get(name="down").amount == 12
+    assert all(obj.fresh for obj in Group.select())
+
+
+@bw2test
+def test_static_dependencies_query_matches_chain():
+    Database("B").register()
+    parameters.new_project_parameters(
+        [{"name": "p", "amount": 1}, {"name": "x", "amount": 1}]
+    )
+    parameters.new_database_parameters(
+        [{"name": "x", "amount": 2}, {"name": "y", "amount": 2}], "B"
+    )
+    parameters.new_activity_parameters(
+        [
+            {"name": "y", "amount": 3, "database": "B", "code": "1"},
+            {"name": "z", "amount": 3, "database": "B", "code": "1"},
+        ],
+        "G1",
+    )
+    parameters.new_activity_parameters(
+        [{"name": "z", "amount": 4, "database": "B", "code": "2"}], "G2"
+    )
+    Group.create(name="A", order=["G1", "G2"])
+    parameters.new_activity_parameters(
+        [{"name": "a", "formula": "p + x + y + z", "database": "B", "code": "3"}], "A"
+    )
+    expected = {"p": 1, "x": 2, "y": 3, "z": 3}
+    assert ActivityParameter._static_dependencies_query("A") == expected
+    assert ActivityParameter._static_dependencies_chain("A") == expected
+    assert ActivityParameter._static_dependencies("A") == expected
+    assert ActivityParameter.get(name="a").amount == 9
+
+    # Pickled orders fall back to the query per group
+    parameters.db.execute_sql(
+        "UPDATE group_table SET \"order\" = ? WHERE name = 'A'",
+        (pickle.dumps(["G1", "G2"], protocol=4),),
+    )
+    _GROUP_CACHE.clear()
+    with pytest.raises(OperationalError):
+        ActivityParameter._static_dependencies_query("A")
+    assert ActivityParameter._static_dependencies("A") == expected
+
+
+@bw2test
+def test_static_dependencies_query_errors_raised(monkeypatch):
+    Database("B").register()
+    ActivityParameter.create(group="A", database="B", code="C", name="D", amount=1)
+    # ``bw2data.parameters`` is the ``ParameterManager``, not the module
+    module = sys.modules["bw2data.parameters"]
+    monkeypatch.setattr(module, "STATIC_DEPENDENCIES_QUERY", "SELECT * FROM missing")
+    with pytest.raises(OperationalError):
+        ActivityParameter._static_dependencies("A")
+
+
+@bw2test
+def test_group_create_table_updated_default_migration():
+    Database("B").register()
+    parameters.db.execute_sql('DROP TABLE "group_table"')
+    parameters.db.execute_sql(
+        'CREATE TABLE "group_table" ("id" INTEGER NOT NULL PRIMARY KEY, '
+        '"name" TEXT NOT NULL, "fresh" INTEGER NOT NULL, '
+        '"updated" DATETIME NOT NULL, "order" BLOB NOT NULL)'
+    )
+    parameters.db.execute_sql(
+        'CREATE UNIQUE INDEX "group_table_name" ON "group_table" ("name")'
+    )
+    parameters.db.execute_sql(
+        'INSERT INTO group_table (name, fresh, updated, "order") '
+        "VALUES ('A', 1, '2000-01-01 00:00:00', '[]')"
+    )
+
+    Group.create_table()
+
+    assert Group.get(name="A").updated == datetime.datetime(2000, 1, 1)
+    Group.create(name="C")
+    assert Group.get(name="C").updated
+    # Triggers on the parameter tables still update the group
+    ActivityParameter.create(group="A", database="B", code="D", name="E", amount=1)
+    assert Group.get(name="A").updated > datetime.datetime(2000, 1, 1)
+    # Nothing to do the second time
+    Group.create_table()
+    assert Group.select().count() == 2